@@ -2,13 +2,22 @@
 Generate thumbnail for a given image-url and returns the thumbnail file.
 Supports caching of the generated thumbnails.
 """
+import contextlib
+import functools
 import hashlib
+import io
 import logging
-import urllib
-from urllib import request, error
-from typing import Optional, Tuple
-from PIL import Image, ImageOps
+import mmap
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple, Union
+from PIL import ExifTags, Image, ImageColor, ImageOps, features
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import urllib3
 
 USER_AGENT = 'Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.7) Gecko/2009021910 Firefox/3.0.7'
 DEFAULT_SIZE = (200, 200)  # Default size of the thumbnail in pixels
@@ -16,11 +25,68 @@ FILL_COLOR = "#34495e"
 TMP_DIR = '/tmp/'
 ORIGINALS_DIR = 'originals'  # Directory-name to save the original images
 THUMBNAILS_DIR = 'thumbnails'  # Directory-name to save the generated thumbnails
+THUMBNAIL_FILE_NAME_RE = re.compile(r'([0-9a-f]+)\.(\d+x\d+)\.([a-z0-9]+)')  # hash_id.size.format
+ORIGINAL_FILE_NAME_RE = re.compile(r'([0-9a-f]+)\.([a-z0-9]+)')  # hash_id.format
+INDEX_FILE = 'index.db'  # File-name of the SQLite index of the cached files, saved in the cache directory
+INDEX_TIMEOUT = 30  # Seconds to wait for other processes to finish writing to the index database
+CACHE_SHARDS = frozenset(f'{i:02x}' for i in range(256))  # Subdirectory-names, the first two hex digits of hash-ids
+RESAMPLE = Image.Resampling.BICUBIC  # Resampling filter used to resize the image
+REDUCING_GAP = 3.0  # Shrink large images with a fast integer reduction first, down to 3x the thumbnail size
+# Encoder options per thumbnail format. JPEG uses the baseline encoder, whose libjpeg-turbo path is SIMD accelerated,
+# instead of the slower progressive/optimized Huffman paths.
+SAVE_OPTIONS = {
+    'jpeg': {'quality': 80, 'subsampling': '4:2:0', 'optimize': False, 'progressive': False},
+    'webp': {'quality': 80, 'method': 4},
+}
+# Image modes that can be saved per thumbnail format without conversion. Thumbnails in other modes, e.g. CMYK as PNG,
+# are converted to RGB, or to RGBA if they have an alpha channel and the format supports it.
+SAVE_MODES = {
+    'jpeg': ('1', 'L', 'RGB', 'CMYK'),
+    'png': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'),
+    'gif': ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16', 'F'),
+    'bmp': ('1', 'L', 'P', 'RGB', 'RGBA'),
+}
+BACKGROUND_CACHE_SIZE = 16  # Number of thumbnail backgrounds (per image mode, size and color) kept in memory
+URL_HASH_CACHE_SIZE = 4096  # Number of recently hashed URLs kept in memory
+HTTP_NUM_POOLS = 64  # Max number of hosts for which keep-alive connections are kept
+HTTP_POOL_SIZE = 32  # Max number of keep-alive connections kept per host
+HTTP_TIMEOUT = 10  # Connect and read timeout in seconds for downloading an image
+HTTP_RETRIES = 2  # Number of retries on connection errors, with a short exponential backoff
+HTTP_REDIRECTS = 10  # Max number of redirects followed for an image URL
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes copied per read while streaming a download to disk
+TMP_FILE_SUFFIX = '.tmp'  # Suffix of the files being written in the cache directory, before they are renamed
+# Start method of the process pool of generate_thumbnails. Its workers are started from the download threads, and
+# forking a multithreaded process can deadlock on locks held by the other threads.
+PROCESS_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+@functools.lru_cache(maxsize=URL_HASH_CACHE_SIZE)
+def _hash_url(image_url: str) -> str:
+    """
+    Hash the image URL into the hash-id used to name its cached files. The hash is only used as a file-name key,
+    so MD5 is kept for compatibility with existing caches and flagged as not used for security.
+    :param image_url: URL of the image
+    :return: hex digest of the URL
+    """
+    return hashlib.md5(image_url.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+@functools.lru_cache(maxsize=BACKGROUND_CACHE_SIZE)
+def _background(mode: str, size: Tuple[int, int], color: str) -> Image.Image:
+    """
+    Create a background image filled with the given color. The image is cached and shared, so it has to be copied
+    before pasting anything on it; copying is a single memcpy, cheaper than creating and filling a new image.
+    :param mode: image mode
+    :param size: size of the image in pixels
+    :param color: fill color
+    :return: background image
+    """
+    return Image.new(mode, size, color)
 
 
 class ThumbnailManager:
     def __init__(self, thumbnail_size: Optional[Tuple[int, int]] = DEFAULT_SIZE, cache_dir: Optional[str] = None,
-                 save_original: bool = False, fill_color: str = FILL_COLOR):
+                 save_original: bool = False, fill_color: str = FILL_COLOR, output_format: Optional[str] = None):
         """
         Initialize the ThumbnailManager object with the given thumbnail size and cache directory.
         :param thumbnail_size: size of the thumbnail in pixels :param cache_dir: directory to save the generated
@@ -28,17 +94,47 @@ class ThumbnailManager:
         :param save_original: option to save original image in the cache directory. If True, the original image is
         saved under /original/ directory.
         :param fill_color: color to fill the background with the thumbnail
+        :param output_format: file format of the generated thumbnails, e.g. 'webp'. If None, the thumbnail is saved in
+        the format of the original image.
         """
-        self.thumbnail_size = thumbnail_size
+        self.thumbnail_size = tuple(thumbnail_size)
         self.save_original = save_original
         self.fill_color = fill_color
+        if isinstance(fill_color, str):
+            # Parse the fill color once, so that an invalid color fails here instead of on every thumbnail
+            ImageColor.getrgb(fill_color)
+        self.output_format = None
+        if output_format:
+            # Accept file extensions as well as format names, e.g. 'jpg' for 'jpeg'
+            image_format = Image.registered_extensions().get('.' + output_format.lower())
+            if not image_format:
+                raise ValueError(f"ThumbnailManager: Unsupported output format: {output_format}")
+            self.output_format = image_format.lower()
+        self._size_str = 'x'.join(map(str, self.thumbnail_size))
+        # Shared connection pool, so repeated downloads from the same host reuse the TCP/TLS connection
+        self._http = urllib3.PoolManager(num_pools=HTTP_NUM_POOLS, maxsize=HTTP_POOL_SIZE, block=False,
+                                         headers={'User-Agent': USER_AGENT}, timeout=HTTP_TIMEOUT,
+                                         retries=urllib3.Retry(total=None, connect=HTTP_RETRIES, read=HTTP_RETRIES,
+                                                               other=HTTP_RETRIES, redirect=HTTP_REDIRECTS,
+                                                               backoff_factor=0.2))
+
+        if not features.check_feature('libjpeg_turbo'):
+            logging.warning("ThumbnailManager: Pillow is not built against libjpeg-turbo. JPEG decoding will be "
+                            "significantly slower.")
 
         self.thumbnails_dir = os.path.join(cache_dir, THUMBNAILS_DIR) if cache_dir else None
         self.originals_dir = os.path.join(cache_dir, ORIGINALS_DIR) if cache_dir else None
-        self.file_names = {}
+        # Prefix of cached thumbnail paths, to build them by concatenation on the cache-hit path
+        self._thumbnails_prefix = os.path.join(self.thumbnails_dir, '') if cache_dir else None
+        # Guards the index database connection, which is shared by the threads of generate_thumbnails
+        self._lock = threading.Lock()
+        self._db = None  # Connection to the index database of the cache directory
 
         if self.thumbnails_dir:
             try:
+                # Files are spread over 256 subdirectories named after the first two hex digits of their hash-id, to
+                # keep the number of entries per directory small. The subdirectories are created before their first
+                # file is written, see _generate_thumbnail.
                 os.makedirs(self.thumbnails_dir, exist_ok=True)
                 if self.save_original:
                     os.makedirs(self.originals_dir, exist_ok=True)
@@ -46,17 +142,135 @@ class ThumbnailManager:
                 raise Exception(f"ThumbnailManager: Error while creating cache directory: {e}. Unable to create cache "
                                 f"directory for saving thumbnails.")
 
-            # load all file-names-hashids in hashmap
-            for filename in os.listdir(self.thumbnails_dir):
-                try:
-                    (hash_id, size, ext) = filename.split('.')
-                    self.file_names[hash_id] = filename
-                except ValueError as e:
-                    logging.error(f"ThumbnailManager: Error while reading thumbnail file: {e}. Unable to read the "
-                                  f"thumbnail file: {filename}")
+            # The cached files are looked up in an SQLite index of the cache directory, shared by all processes using
+            # the same cache directory, so that a ThumbnailManager starts without listing every cached file. Caches
+            # without an index are scanned once and the index is created.
+            index_file = os.path.join(cache_dir, INDEX_FILE)
+            index_exists = os.path.isfile(index_file)
+            self._open_index(index_file)
+            if not index_exists:
+                self._write_index(*self._scan_cache())
             logging.info(f"ThumbnailManager: Cache directory: {self.thumbnails_dir}, "
                          f"Originals directory: {self.originals_dir}")
 
+    def _scan_cache(self) -> Tuple[List[Tuple[str, str, str, str]], List[Tuple[str, str]]]:
+        """
+        List the files in the cache directory, to build the index database from.
+        :return: (hash_id, size, format, file path) rows of the thumbnails and (hash_id, file path) rows of the
+        originals, with the file paths relative to their cache directory
+        """
+        thumbnails = []
+        originals = []
+        for (file_name, file_path) in self._scan_cache_dir(self.thumbnails_dir):
+            match = THUMBNAIL_FILE_NAME_RE.fullmatch(file_name)
+            if not match:
+                logging.error(f"ThumbnailManager: Error while reading thumbnail file: unexpected file name. Unable to "
+                              f"read the thumbnail file: {file_path}")
+                continue
+            (hash_id, size, ext) = match.groups()
+            thumbnails.append((hash_id, size, ext, file_path))
+        if os.path.isdir(self.originals_dir):
+            for (file_name, file_path) in self._scan_cache_dir(self.originals_dir):
+                match = ORIGINAL_FILE_NAME_RE.fullmatch(file_name)
+                if not match:
+                    logging.error(f"ThumbnailManager: Error while reading original image file: unexpected file name. "
+                                  f"Unable to read the original image file: {file_path}")
+                    continue
+                (hash_id, ext) = match.groups()
+                originals.append((hash_id, file_path))
+        return thumbnails, originals
+
+    def _open_index(self, index_file: str):
+        """
+        Connect to the given index database, creating its tables if needed. The database is in WAL mode, so that
+        processes sharing the cache directory read the index while another one writes to it.
+        :param index_file: path of the index database
+        """
+        try:
+            # Autocommit mode, each statement is its own transaction unless BEGIN is executed explicitly
+            self._db = sqlite3.connect(index_file, timeout=INDEX_TIMEOUT, isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Thumbnails of the same image and size may be cached in several formats, by managers with different
+            # output formats
+            self._db.execute("CREATE TABLE IF NOT EXISTS thumbnails (hash_id TEXT, size TEXT, format TEXT, "
+                             "file_name TEXT, PRIMARY KEY (hash_id, size, format))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS originals (hash_id TEXT PRIMARY KEY, file_name TEXT)")
+        except sqlite3.Error as e:
+            raise Exception(f"ThumbnailManager: Error while opening index database: {e}. Unable to open the index "
+                            f"database {index_file}.")
+
+    def _write_index(self, thumbnails: List[Tuple[str, str, str, str]], originals: List[Tuple[str, str]]):
+        """
+        Write the rows listed by _scan_cache to the index database, in a single transaction.
+        :param thumbnails: (hash_id, size, format, file path) rows of the thumbnails
+        :param originals: (hash_id, file path) rows of the originals
+        """
+        try:
+            with self._lock, self._index_transaction():
+                self._db.executemany("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?)", thumbnails)
+                self._db.executemany("INSERT OR REPLACE INTO originals VALUES (?, ?)", originals)
+        except sqlite3.Error as e:
+            raise Exception(f"ThumbnailManager: Error while writing index database: {e}. Unable to index the cache "
+                            f"directory.")
+
+    @contextlib.contextmanager
+    def _index_transaction(self):
+        """
+        Run the statements of the with-block in a single write transaction of the index database, which is rolled
+        back if any of them fails. Must be called while holding the lock.
+        """
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self._db.execute("COMMIT")
+        except BaseException:
+            # Some errors already roll the transaction back
+            if self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+            raise
+
+    def _get_thumbnail_file_name(self, hash_id: str) -> Optional[str]:
+        """
+        Look up the thumbnail of this manager's size and output format with the given hash-id in the index database.
+        Without an output format, a thumbnail of any format is served. The database is the only index, so that
+        thumbnails added or removed by other processes are seen right away.
+        :param hash_id: hash-id of the image URL
+        :return: thumbnail file path relative to thumbnails_dir, or None if it is not cached
+        """
+        try:
+            with self._lock:
+                if self.output_format:
+                    row = self._db.execute("SELECT file_name FROM thumbnails WHERE hash_id = ? AND size = ? AND "
+                                           "format = ?", (hash_id, self._size_str, self.output_format)).fetchone()
+                else:
+                    row = self._db.execute("SELECT file_name FROM thumbnails WHERE hash_id = ? AND size = ?",
+                                           (hash_id, self._size_str)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Error while reading index database: {e}. Unable to look up the thumbnail {hash_id}.")
+            return None
+        return row[0] if row else None
+
+    @staticmethod
+    def _scan_cache_dir(cache_dir: str) -> Iterator[Tuple[str, str]]:
+        """
+        List the files in the given cache directory and in its hash-id subdirectories. Files directly in the cache
+        directory were saved before the cache was split into subdirectories, and are still served from there. Files
+        that are still being written are skipped.
+        :param cache_dir: cache directory to scan
+        :return: iterator of (file name, file path relative to cache_dir) pairs
+        """
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                # DirEntry caches the file type reported by the directory listing, so this costs no stat call
+                if entry.is_file() and not entry.name.endswith(TMP_FILE_SUFFIX):
+                    yield entry.name, entry.name
+                elif entry.is_dir() and entry.name in CACHE_SHARDS:
+                    with os.scandir(entry.path) as shard_entries:
+                        for shard_entry in shard_entries:
+                            if shard_entry.is_file() and not shard_entry.name.endswith(TMP_FILE_SUFFIX):
+                                yield shard_entry.name, os.path.join(entry.name, shard_entry.name)
+
     def generate_thumbnail(self, image_url: str) -> Optional[str]:
         """
         Generate thumbnail for the given image URL. If cache_dir is provided, then the generated thumbnail is saved
@@ -64,68 +278,420 @@ class ThumbnailManager:
         :param image_url:
         :return: absolute path of the generated thumbnail file
         """
-        headers = {'User-Agent': USER_AGENT}
+        hash_id = _hash_url(image_url)
+        return self._get_cached_thumbnail(image_url, hash_id) or self._generate_thumbnail(image_url, hash_id)
 
-        hash_id = hashlib.md5(image_url.encode("utf-8")).hexdigest()
-        size = 'x'.join(map(str, self.thumbnail_size))
+    def _generate_thumbnail(self, image_url: str, hash_id: str, executor: Optional[Executor] = None) -> Optional[str]:
+        """
+        Generate thumbnail for the given image URL, see generate_thumbnail. The caller has already looked it up in
+        the cache directory.
+        :param image_url: URL of the image
+        :param hash_id: hash-id of the image URL, computed once by the caller
+        :param executor: optional executor to decode, resize and save the image on, e.g. a process pool
+        :return: absolute path of the generated thumbnail file
+        """
+        # Keep the image data in memory, unless the original image has to be saved in the cache directory
+        image_file = None
         if self.thumbnails_dir:
-            # Check if the thumbnail already exists in the cache directory
-            if hash_id in self.file_names:
-                logging.debug(f"Thumbnail already exists for the image: {image_url}: {self.file_names[hash_id]}")
-                return os.path.join(self.thumbnails_dir, self.file_names[hash_id])
+            try:
+                os.makedirs(os.path.join(self.thumbnails_dir, hash_id[:2]), exist_ok=True)
+                if self.save_original:
+                    original_dir = os.path.join(self.originals_dir, hash_id[:2])
+                    os.makedirs(original_dir, exist_ok=True)
+                    # Download into a file of its own, which is renamed to hash_id.format once decoded. Other threads
+                    # and processes generating the same thumbnail can then never truncate it while it is being read.
+                    image_file = self._tmp_file_path(os.path.join(original_dir, hash_id))
+            except OSError as e:
+                logging.error(f"Error while creating cache directory: {e}. Unable to save the thumbnail for the URL: "
+                              f"{image_url}")
+                return None
+
+        image_source = self._download_image(image_url, image_file)
+        if image_source is None:
+            if image_file:
+                self._remove_file(image_file)
+            return None
 
-        # Fetch image from image_url
+        # Generate thumbnail. If cache directory is not provided then the thumbnail is saved as a temporary file in
+        # the TMP_DIR
+        thumbnail_dir = os.path.join(self.thumbnails_dir, hash_id[:2]) if self.thumbnails_dir else TMP_DIR
+        thumbnail_file_prefix = os.path.join(thumbnail_dir, '.'.join([hash_id, self._size_str]))
+        render_args = (image_source, thumbnail_file_prefix, self.thumbnail_size, self.fill_color,
+                       self.output_format)
         try:
-            img_request = urllib.request.Request(image_url, None, headers)
-            img_response = urllib.request.urlopen(img_request)
-        except urllib.error.HTTPError as e:
-            logging.error(f"HTTP Error: {e.code}. Unable to download image from the URL: {image_url}")
+            if executor:
+                thumbnail_file, image_format = executor.submit(self._render_thumbnail, *render_args).result()
+            else:
+                thumbnail_file, image_format = self._render_thumbnail(*render_args)
+        except Exception as e:
+            logging.error(f"Error while generating thumbnail: {e}. Unable to generate thumbnail for the image.")
+            if image_file:
+                self._remove_file(image_file)
+            return None
+
+        if self.thumbnails_dir:
+            with self._lock:
+                thumbnail_file_name = os.path.relpath(thumbnail_file, self.thumbnails_dir)
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?)",
+                                     (hash_id, self._size_str, self.output_format or image_format,
+                                      thumbnail_file_name))
+                except sqlite3.Error as e:
+                    # The thumbnail is still returned, it is generated again the next time it is requested
+                    logging.error(f"Error while writing index database: {e}. Unable to index the thumbnail file "
+                                  f"{thumbnail_file}.")
+                if self.save_original:
+                    # Rename the original image file to the hash_id.format
+                    original_file_name = os.path.join(hash_id[:2], '.'.join([hash_id, image_format]))
+                    try:
+                        os.replace(image_file, os.path.join(self.originals_dir, original_file_name))
+                        self._db.execute("INSERT OR REPLACE INTO originals VALUES (?, ?)",
+                                         (hash_id, original_file_name))
+                    except OSError as e:
+                        logging.error(f"Error while renaming the original image file: {e}. Unable to rename the "
+                                      f"original image file {image_file}.")
+                        self._remove_file(image_file)
+                    except sqlite3.Error as e:
+                        logging.error(f"Error while writing index database: {e}. Unable to index the original image "
+                                      f"file {original_file_name}.")
+        return thumbnail_file
+
+    def _download_image(self, image_url: str, image_file: Optional[str] = None) -> Optional[Union[str, bytes]]:
+        """
+        Download the image from the given URL, either streamed into image_file or into memory.
+        :param image_url: URL of the image
+        :param image_file: path of the file to save the image to. If None, the image is kept in memory.
+        :return: image_file, or the image data if image_file is None. None if the download failed.
+        """
+        try:
+            img_response = self._http.request('GET', image_url, preload_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            logging.error(f"HTTP Error: {e}. Unable to download image from the URL: {image_url}")
+            return None
+        if img_response.status >= 400:
+            logging.error(f"HTTP Error: {img_response.status}. Unable to download image from the URL: {image_url}")
+            # Read the error body, so that the connection goes back to the pool instead of being closed
+            img_response.drain_conn()
+            img_response.release_conn()
             return None
 
-        # Save the image data to a temporary file
-        data = img_response.read()
-        image_file = os.path.join(self.originals_dir, hash_id) if self.save_original else (
-            os.path.join(TMP_DIR, 'tmp_' + hash_id))
         try:
-            with open(image_file, 'wb') as f:
-                f.write(data)
-                f.close()
+            if image_file:
+                with open(image_file, 'wb') as f:
+                    shutil.copyfileobj(img_response, f, length=DOWNLOAD_CHUNK_SIZE)
+                return image_file
+            return img_response.read()
         except FileExistsError as e:
             logging.error(f"File exists error: {e}. Unable to write image data to a file {image_file}.")
             return None
+        except urllib3.exceptions.HTTPError as e:
+            logging.error(f"HTTP Error: {e}. Unable to download image from the URL: {image_url}")
+            return None
+        finally:
+            img_response.release_conn()
 
-        # Open the saved image file
-        try:
-            image = Image.open(image_file)
-        except FileNotFoundError as e:
-            logging.error(f"File not found error: {e}"
-                          f"Unable to open the temporary image file.")
+    def _get_cached_thumbnail(self, image_url: str, hash_id: str) -> Optional[str]:
+        """
+        Look up the thumbnail of the given image URL in the cache directory.
+        :param image_url: URL of the image
+        :param hash_id: hash-id of the image URL
+        :return: absolute path of the cached thumbnail file, or None if it is not cached
+        """
+        if not self.thumbnails_dir:
             return None
-        except Exception as e:
-            logging.error(f"Error while opening the image file: {e}. Unable to open the image file.")
+        # Only thumbnails of this manager's size and output format are served, thumbnails of other sizes and formats may
+        # share the cache directory
+        thumbnail_file_name = self._get_thumbnail_file_name(hash_id)
+        if not thumbnail_file_name:
+            return None
+        thumbnail_file = self._thumbnails_prefix + thumbnail_file_name
+        # The cache directory is not scanned again once it is indexed, so thumbnails deleted by other tools are only
+        # noticed here, and generated again
+        if not os.path.isfile(thumbnail_file):
+            self._remove_missing_file('thumbnails', hash_id, thumbnail_file_name, thumbnail_file)
             return None
+        # Lazy %-formatting, so cache hits don't pay for formatting a message that is usually discarded
+        logging.debug("Thumbnail already exists for the image: %s: %s", image_url, thumbnail_file_name)
+        return thumbnail_file
 
-        # Generate thumbnail
+    def _remove_missing_file(self, table: str, hash_id: str, file_name: str, file: str):
+        """
+        Remove the row of a cached file that no longer exists from the index database.
+        :param table: index table of the file, 'thumbnails' or 'originals'
+        :param hash_id: hash-id of the image URL
+        :param file_name: file path relative to its cache directory, as stored in the index
+        :param file: absolute path of the file
+        """
+        logging.warning(f"ThumbnailManager: Indexed file is missing from the cache directory: {file}")
+        try:
+            with self._lock:
+                self._db.execute(f"DELETE FROM {table} WHERE hash_id = ? AND file_name = ?", (hash_id, file_name))
+        except sqlite3.Error as e:
+            logging.error(f"Error while writing index database: {e}. Unable to remove the missing file {file} from "
+                          f"the index.")
+
+    @staticmethod
+    def _tmp_file_path(file: str) -> str:
+        """
+        Get a path to write the given file to before renaming it into place. The path is unique to the calling process
+        and thread.
+        :param file: path of the file
+        :return: path of the temporary file, in the directory of the file, skipped by _scan_cache_dir
+        """
+        (file_dir, file_name) = os.path.split(file)
+        return os.path.join(file_dir, f".{file_name}.{os.getpid()}.{threading.get_ident()}{TMP_FILE_SUFFIX}")
+
+    @staticmethod
+    def _remove_file(file: str):
+        """
+        Remove the given file from the cache directory, if it exists.
+        :param file: path of the file
+        """
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error while removing the file: {e}. Unable to remove the file {file}.")
+
+    @staticmethod
+    def _render_thumbnail(image_source: Union[str, bytes], thumbnail_file_prefix: str, thumbnail_size: Tuple[int, int],
+                          fill_color: str, output_format: Optional[str]) -> Tuple[str, str]:
+        """
+        Decode the image, resize and pad it to the thumbnail size, and save the thumbnail. This is the CPU-bound part
+        of generating a thumbnail, so it only takes picklable arguments and can run in a separate process.
+        :param image_source: path of the original image file, or the image data
+        :param thumbnail_file_prefix: path of the thumbnail file, without the format extension
+        :param thumbnail_size: size of the thumbnail in pixels
+        :param fill_color: color to fill the background with the thumbnail
+        :param output_format: file format of the thumbnail. If None, the format of the original image is used.
+        :return: path of the saved thumbnail file and the format of the original image
+        """
+        (thumbnail, thumbnail_format, image_format) = ThumbnailManager._create_thumbnail(
+            image_source, thumbnail_size, fill_color, output_format)
+        thumbnail_file = '.'.join([thumbnail_file_prefix, thumbnail_format])
+        # Save into a temporary file that is renamed over the thumbnail file, so that other processes sharing the
+        # cache directory never serve a partially written thumbnail
+        tmp_thumbnail_file = ThumbnailManager._tmp_file_path(thumbnail_file)
         try:
-            image_format = image.format.lower()
-            thumbnail_file_name = '.'.join([hash_id, size, image_format])
-
-            if not self.thumbnails_dir:
-                # If cache directory is not provided then return the thumbnail saved as a temporary file in the TMP_DIR
-                thumbnail_file = os.path.join(TMP_DIR, thumbnail_file_name)
-                ImageOps.pad(image, self.thumbnail_size, color=self.fill_color).save(fp=thumbnail_file)
-                return thumbnail_file
-
-            ImageOps.pad(image, self.thumbnail_size, color=self.fill_color).save(
-                    fp=os.path.join(self.thumbnails_dir, thumbnail_file_name))
-            # Delete if the original image is not required to be saved
-            if not self.save_original:
-                os.remove(image_file)
+            with open(tmp_thumbnail_file, 'xb') as f:
+                thumbnail.save(f, format=thumbnail_format, **SAVE_OPTIONS.get(thumbnail_format, {}))
+            os.replace(tmp_thumbnail_file, thumbnail_file)
+        except BaseException:
+            ThumbnailManager._remove_file(tmp_thumbnail_file)
+            raise
+        return thumbnail_file, image_format
+
+    @staticmethod
+    def _create_thumbnail(image_source: Union[str, bytes], thumbnail_size: Tuple[int, int], fill_color: str,
+                          output_format: Optional[str]) -> Tuple[Image.Image, str, str]:
+        """
+        Decode the image, and resize and pad it to the thumbnail size.
+        :param image_source: path of the original image file, or the image data
+        :param thumbnail_size: size of the thumbnail in pixels
+        :param fill_color: color to fill the background with the thumbnail
+        :param output_format: file format of the thumbnail. If None, the format of the original image is used.
+        :return: thumbnail image, format of the thumbnail and format of the original image
+        """
+        if isinstance(image_source, str):
+            # Decode the saved original from a read-only memory map, as a single contiguous buffer
+            with open(image_source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image_data:
+                image = ThumbnailManager._load_image(image_data, thumbnail_size)
+        else:
+            image = ThumbnailManager._load_image(io.BytesIO(image_source), thumbnail_size)
+
+        image_format = image.format.lower()
+        thumbnail_format = output_format or image_format
+        thumbnail = ThumbnailManager._pad(image, thumbnail_size, fill_color)
+        save_modes = SAVE_MODES.get(thumbnail_format)
+        if save_modes and thumbnail.mode not in save_modes:
+            thumbnail = thumbnail.convert('RGBA' if 'A' in thumbnail.getbands() and 'RGBA' in save_modes else 'RGB')
+        return thumbnail, thumbnail_format, image_format
+
+    @staticmethod
+    def _load_image(fp, thumbnail_size: Tuple[int, int]) -> Image.Image:
+        """
+        Open and decode the image from the given file object. The image is decoded right away, so that the file
+        object can be released as soon as this returns.
+        :param fp: file object holding the image data
+        :param thumbnail_size: size of the thumbnail the image is decoded for
+        :return: decoded image
+        """
+        image = Image.open(fp)
+        # EXIF orientations 5 to 8 rotate the image by 90 degrees, which swaps its width and height
+        rotated = image.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+        if image.format == 'JPEG':
+            # Let libjpeg decode at a reduced DCT scale (1/2, 1/4 or 1/8) that still leaves enough pixels for a good
+            # quality resize, instead of decoding the image at full resolution. The scale is based on the size the
+            # image is resized to, not on the padded thumbnail size, so that wide and tall images are reduced as well.
+            if rotated:
+                (height, width) = ThumbnailManager._contain_size(image.size[::-1], thumbnail_size)
             else:
-                # Rename the original image file to the hash_id.format
-                os.rename(image_file, '.'.join([image_file, image_format]))
+                (width, height) = ThumbnailManager._contain_size(image.size, thumbnail_size)
+            image.draft('RGB', (width * 2, height * 2))
+        image.load()
+        # Apply the EXIF orientation, on the already reduced image, so that photos are not shown sideways
+        ImageOps.exif_transpose(image, in_place=True)
+        return image
+
+    @staticmethod
+    def _contain_size(image_size: Tuple[int, int], thumbnail_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Compute the largest size within the thumbnail size that keeps the aspect ratio of the image, like
+        ImageOps.contain.
+        :param image_size: size of the image in pixels
+        :param thumbnail_size: size of the thumbnail in pixels
+        :return: size of the resized image in pixels
+        """
+        (image_width, image_height) = image_size
+        (width, height) = thumbnail_size
+        if image_width / image_height > width / height:
+            return width, max(1, round(image_height / image_width * width))
+        return max(1, round(image_width / image_height * height)), height
 
-            return os.path.join(self.thumbnails_dir, thumbnail_file_name)
+    @staticmethod
+    def _pad(image: Image.Image, thumbnail_size: Tuple[int, int], fill_color: str) -> Image.Image:
+        """
+        Resize the image to fit within the thumbnail size and pad it with the fill color, like ImageOps.pad. Unlike
+        ImageOps.pad, large images are first shrunk with a fast integer reduction and only the final pass runs the
+        resampling filter, on a much smaller image.
+        :param image: image to generate the thumbnail from
+        :param thumbnail_size: size of the thumbnail in pixels
+        :param fill_color: color to fill the background with the thumbnail
+        :return: thumbnail image
+        """
+        width, height = thumbnail_size
+        size = ThumbnailManager._contain_size(image.size, thumbnail_size)
+        resized = image.resize(size, RESAMPLE, reducing_gap=REDUCING_GAP)
+        if resized.size == thumbnail_size:
+            return resized
+
+        thumbnail = _background(resized.mode, thumbnail_size, fill_color).copy()
+        if resized.palette:
+            thumbnail.putpalette(resized.getpalette())
+        thumbnail.paste(resized, ((width - resized.width) // 2, (height - resized.height) // 2))
+        return thumbnail
+
+    def generate_thumbnails(self, image_urls: List[str], max_workers: int = HTTP_POOL_SIZE,
+                            cpu_workers: Optional[int] = None) -> List[Optional[str]]:
+        """
+        Generate thumbnails for the given image URLs concurrently. Downloads run on a thread pool sharing the pooled
+        HTTP connections. By default the images are also decoded and resized on these threads, which overlap because
+        Pillow releases the GIL while decoding and resizing. For large batches, cpu_workers moves that work to a
+        process pool instead, so it scales across all cores.
+        :param image_urls: list of image URLs
+        :param max_workers: maximum number of URLs processed at the same time
+        :param cpu_workers: number of processes to decode and resize the images on. If None, no process pool is used.
+        :return: absolute paths of the generated thumbnail files, in the order of image_urls (None for failures)
+        """
+        # Hash the whole batch and resolve the cached thumbnails up front, so that the pools are only started for the
+        # URLs that still have to be generated. Each URL is processed only once, so that concurrent workers never
+        # write the same original image file.
+        thumbnail_files = {}
+        pending_urls = []
+        pending_hash_ids = []
+        for image_url in image_urls:
+            if image_url not in thumbnail_files:
+                hash_id = _hash_url(image_url)
+                thumbnail_files[image_url] = self._get_cached_thumbnail(image_url, hash_id)
+                if not thumbnail_files[image_url]:
+                    pending_urls.append(image_url)
+                    pending_hash_ids.append(hash_id)
+
+        if pending_urls:
+            with contextlib.ExitStack() as stack:
+                cpu_executor = None
+                if cpu_workers:
+                    mp_context = multiprocessing.get_context(PROCESS_START_METHOD)
+                    cpu_executor = stack.enter_context(ProcessPoolExecutor(max_workers=cpu_workers,
+                                                                           mp_context=mp_context))
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=min(max_workers, len(pending_urls))))
+                generate_thumbnail = functools.partial(self._generate_thumbnail, executor=cpu_executor)
+                thumbnail_files.update(zip(pending_urls, executor.map(generate_thumbnail, pending_urls,
+                                                                      pending_hash_ids)))
+        return [thumbnail_files[image_url] for image_url in image_urls]
+
+    def generate_thumbnail_bytes(self, image_url: str) -> Optional[bytes]:
+        """
+        Generate thumbnail for the given image URL entirely in memory, e.g. to serve it over HTTP. Neither the
+        thumbnail nor the original image is written to disk, and the cache directory is not used.
+        :param image_url: URL of the image
+        :return: encoded thumbnail, in output_format or else in the format of the original image
+        """
+        image_data = self._download_image(image_url)
+        if image_data is None:
+            return None
+
+        try:
+            (thumbnail, thumbnail_format, _) = self._create_thumbnail(image_data, self.thumbnail_size, self.fill_color,
+                                                                      self.output_format)
+            thumbnail_data = io.BytesIO()
+            thumbnail.save(thumbnail_data, format=thumbnail_format, **SAVE_OPTIONS.get(thumbnail_format, {}))
+            return thumbnail_data.getvalue()
         except Exception as e:
             logging.error(f"Error while generating thumbnail: {e}. Unable to generate thumbnail for the image.")
             return None
+
+    def get_original_image_file(self, image_url: str) -> Optional[str]:
+        """
+        Get the saved original image of the given image URL, looked up in the index of the originals directory.
+        :param image_url: URL of the image
+        :return: absolute path of the saved original image file, or None if it is not saved
+        """
+        if not self.originals_dir:
+            return None
+        hash_id = _hash_url(image_url)
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT file_name FROM originals WHERE hash_id = ?", (hash_id,)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Error while reading index database: {e}. Unable to look up the original image of the "
+                          f"URL: {image_url}")
+            return None
+        if not row:
+            return None
+        original_file = os.path.join(self.originals_dir, row[0])
+        if not os.path.isfile(original_file):
+            self._remove_missing_file('originals', hash_id, row[0], original_file)
+            return None
+        return original_file
+
+    def remove_thumbnail(self, image_url: str) -> bool:
+        """
+        Remove the cached thumbnails of the given image URL, in all sizes and formats, together with its saved original
+        image if any, from the cache directory.
+        :param image_url: URL of the image
+        :return: True if a cached thumbnail was removed
+        """
+        if not self.thumbnails_dir:
+            return False
+
+        hash_id = _hash_url(image_url)
+        try:
+            # Other processes may have added sizes of this thumbnail, so the file names are read from the database,
+            # in the same write transaction as the deletes
+            with self._lock, self._index_transaction():
+                thumbnail_file_names = [row[0] for row in self._db.execute(
+                    "SELECT file_name FROM thumbnails WHERE hash_id = ?", (hash_id,))]
+                row = self._db.execute("SELECT file_name FROM originals WHERE hash_id = ?", (hash_id,)).fetchone()
+                original_file_name = row[0] if row else None
+                self._db.execute("DELETE FROM thumbnails WHERE hash_id = ?", (hash_id,))
+                self._db.execute("DELETE FROM originals WHERE hash_id = ?", (hash_id,))
+        except sqlite3.Error as e:
+            logging.error(f"Error while writing index database: {e}. Unable to remove the thumbnail of the URL: "
+                          f"{image_url}")
+            return False
+        files = [os.path.join(self.thumbnails_dir, file_name) for file_name in thumbnail_file_names]
+        if original_file_name:
+            files.append(os.path.join(self.originals_dir, original_file_name))
+        for file in files:
+            self._remove_file(file)
+        return bool(thumbnail_file_names)
+
+    def close(self):
+        """
+        Release the pooled HTTP connections and the index database held by this ThumbnailManager.
+        """
+        self._http.clear()
+        if self._db:
+            self._db.close()